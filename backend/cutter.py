@@ -1,63 +1,308 @@
 import cv2
 import numpy as np
 import math
+import os
+import threading
+import time
+from deadline import check_deadline
+from memory_budget import MAX_IMAGE_PIXELS, UnreadableImage, UploadTooLarge
+
+# Bump when the measurement math changes so stored results are recomputed
+MEASUREMENT_VERSION = "2"
+
+# Rows kept when downsampling the segmentation mask for the width profile.
+# Bounds the cost of the mask stage regardless of the input resolution.
+MASK_PROFILE_ROWS = 256
+# Time budget for the mask stage; if it runs over, its widths are discarded
+# and chest falls back to the shoulder-width proxy
+MASK_STAGE_BUDGET_MS = float(os.getenv("THOUB_MASK_BUDGET_MS", "50"))
+MASK_THRESHOLD = 0.5
+# Front-to-side ratio of the torso cross-section (ellipse assumption).
+TORSO_DEPTH_RATIO = 0.7
+# Burst/video capture: upper bound on frames analysed and video sampling step
+MAX_BURST_FRAMES = int(os.getenv("THOUB_BURST_MAX_FRAMES", "30"))
+VIDEO_FRAME_STRIDE = 3
+MIN_LANDMARK_VISIBILITY = 0.5
+# imdecode flags for decoding at 1/2, 1/4 and 1/8 scale (measurements are scale-free)
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def _frame_pixels(capture, max_pixels: int) -> int:
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if width <= 0 or height <= 0:
+        raise UnreadableImage("Could not read video frame size")
+    if width * height > max_pixels:
+        raise UploadTooLarge(f"Video is {width}x{height}, over the {max_pixels // 1000000} megapixel limit")
+    return width * height
+
+def video_frame_pixels(path: str, max_pixels: int = MAX_IMAGE_PIXELS) -> int:
+    """
+    Pixels per frame from the video's header, without decoding any frame.
+    Raises UploadTooLarge past `max_pixels`, like memory_budget.image_pixels.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Could not open video")
+    try:
+        return _frame_pixels(capture, max_pixels)
+    finally:
+        capture.release()
+
+def iter_video_frames(path: str, stride: int = VIDEO_FRAME_STRIDE, max_frames: int = MAX_BURST_FRAMES, max_pixels: int = MAX_IMAGE_PIXELS):
+    """
+    Yields BGR frames from a video file one at a time, keeping every `stride`-th frame.
+    The frame size is checked against `max_pixels` before anything is decoded.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Could not open video")
+    try:
+        _frame_pixels(capture, max_pixels)
+        index = 0
+        yielded = 0
+        while yielded < max_frames:
+            # grab() skips decoding for frames we are going to drop
+            if not capture.grab():
+                break
+            if index % stride == 0:
+                ok, frame = capture.retrieve()
+                if ok:
+                    yielded += 1
+                    yield frame
+            index += 1
+    finally:
+        capture.release()
+
+def iter_image_frames(contents, max_frames: int = MAX_BURST_FRAMES):
+    """Decodes an iterable of encoded images lazily, skipping undecodable ones."""
+    for i, content in enumerate(contents):
+        if i >= max_frames:
+            break
+        frame = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            print(f"Warning: Skipping undecodable burst frame {i}")
+            continue
+        yield frame
 
 class Cutter:
-    def __init__(self):
+    def __init__(self, enable_mask_analysis: bool = None):
         self._pose = None
+        # The static Pose graph is not thread-safe (shared timestamps and outputs);
+        # requests now run in the threadpool, so creation and process() are serialised
+        self._pose_lock = threading.Lock()
+        if enable_mask_analysis is None:
+            enable_mask_analysis = os.getenv("THOUB_MASK_ANALYSIS", "false").lower() in ("1", "true", "yes")
+        self.enable_mask_analysis = enable_mask_analysis
+
+    @property
+    def version(self) -> str:
+        """Identifies the algorithm and config behind a result, for the result store."""
+        return f"{MEASUREMENT_VERSION}:mask={int(bool(self.enable_mask_analysis))}"
+
+    @staticmethod
+    def _mp_pose():
+        import mediapipe as mp
+        # Use specific import path if available, or try standard
+        try:
+            import mediapipe.solutions.pose as mp_pose
+        except ImportError:
+            print("Warning: Falling back to mp.solutions.pose")
+            mp_pose = mp.solutions.pose
+        return mp_pose
 
     @property
     def pose(self):
         if self._pose is None:
-            print("INFO: Loading MediaPipe Pose model...")
-            import mediapipe as mp
-            # Use specific import path if available, or try standard
-            try:
-                import mediapipe.solutions.pose as mp_pose
-            except ImportError:
-                print("Warning: Falling back to mp.solutions.pose")
-                mp_pose = mp.solutions.pose
-            
-            self._pose = mp_pose.Pose(
-                static_image_mode=True,
-                model_complexity=2,
-                enable_segmentation=True,
-                min_detection_confidence=0.5
-            )
+            with self._pose_lock:
+                if self._pose is None:
+                    print("INFO: Loading MediaPipe Pose model...")
+                    self._pose = self._mp_pose().Pose(
+                        static_image_mode=True,
+                        model_complexity=2,
+                        enable_segmentation=True,
+                        min_detection_confidence=0.5
+                    )
         return self._pose
 
-    def process(self, image_content: bytes, true_height_cm: float, fit_type: str = "Standard"):
-        # Decode image
+    def tracking_pose(self):
+        """
+        New Pose instance in tracking mode: after the first detection, later
+        frames reuse the previous landmarks instead of running the detector.
+        Tracking state is per-clip, so callers own (and close) the instance.
+        """
+        return self._mp_pose().Pose(
+            static_image_mode=False,
+            model_complexity=2,
+            enable_segmentation=self.enable_mask_analysis,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
+
+    @staticmethod
+    def body_width_profile(mask, center_x: float, max_rows: int = MASK_PROFILE_ROWS):
+        """
+        Computes the row-wise body width (in full-resolution pixels) from a
+        segmentation mask in a single vectorized pass.
+
+        The mask is downsampled to at most `max_rows` rows. For every row the
+        width is the contiguous run of body pixels containing `center_x`, so
+        arms separated from the torso are not counted.
+        Returns (widths, row_scale) where row = int(y * row_scale).
+        """
+        mask_height, mask_width = mask.shape[:2]
+        scale = min(1.0, max_rows / mask_height)
+        small_h = max(1, int(round(mask_height * scale)))
+        small_w = max(1, int(round(mask_width * scale)))
+        small = cv2.resize(mask.astype(np.float32), (small_w, small_h), interpolation=cv2.INTER_AREA)
+        body = small > MASK_THRESHOLD
+
+        c = int(np.clip(round(center_x * small_w / mask_width), 0, small_w - 1))
+
+        # Distance from the center column to the first background pixel on each side
+        left = body[:, c::-1]
+        right = body[:, c:]
+        left_run = np.where(left.all(axis=1), left.shape[1], np.argmin(left, axis=1))
+        right_run = np.where(right.all(axis=1), right.shape[1], np.argmin(right, axis=1))
+
+        widths = np.where(body[:, c], left_run + right_run - 1, 0).astype(np.float32)
+        widths *= mask_width / small_w
+        return widths, small_h / mask_height
+
+    @staticmethod
+    def width_at(profile, y: float, band: int = 2):
+        """Median width of the profile around image row `y` (0 if out of range)."""
+        widths, row_scale = profile
+        row = int(y * row_scale)
+        lo, hi = max(0, row - band), min(len(widths), row + band + 1)
+        if lo >= hi:
+            return 0.0
+        return float(np.median(widths[lo:hi]))
+
+    @staticmethod
+    def ellipse_circumference(width: float, depth_ratio: float = TORSO_DEPTH_RATIO):
+        # Ramanujan's approximation for an ellipse with axes width and width * depth_ratio
+        a = width / 2
+        b = a * depth_ratio
+        return math.pi * (3 * (a + b) - math.sqrt((3 * a + b) * (a + 3 * b)))
+
+    @staticmethod
+    def _fallback_estimate(true_height_cm: float, fit_type: str):
+        # For testing/MVP robustness, return estimated based on height alone
+        # Standard human ratios
+        return {
+            "measurements": {
+                "thobe_length": round(true_height_cm * 0.8, 1),
+                "shoulder_width": round(true_height_cm * 0.25, 1),
+                "sleeve_length": round(true_height_cm * 0.35, 1),
+                "chest_circumference": round(true_height_cm * 0.55, 1),
+                "neck_circumference": 40.0,
+                "wrist_circumference": 18.0
+            },
+            "fit_type": fit_type,
+            "note": "Estimated from height (No pose detected)"
+        }
+
+    def process(self, image_content: bytes, true_height_cm: float, fit_type: str = "Standard", deadline=None, reduce_factor: int = 1):
+        # Decode image (optionally downscaled to bound memory use)
         nparr = np.frombuffer(image_content, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        image = cv2.imdecode(nparr, DECODE_FLAGS.get(reduce_factor, cv2.IMREAD_COLOR))
         if image is None:
             raise ValueError("Could not decode image")
 
         image_height, image_width, _ = image.shape
+        check_deadline(deadline, "inference")
         
         # Run MediaPipe Pose
-        results = self.pose.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        pose = self.pose
+        points = mask = None
+        with self._pose_lock:
+            results = pose.process(rgb)
+            # Copy outputs out while we hold the graph, before another request reuses it
+            if results.pose_landmarks:
+                points = np.array([(lm.x, lm.y) for lm in results.pose_landmarks.landmark])
+                # Only pay for the mask copy under the lock when it will be used
+                if self.enable_mask_analysis and getattr(results, "segmentation_mask", None) is not None:
+                    mask = np.array(results.segmentation_mask, copy=True)
         
-        if not results.pose_landmarks:
+        if points is None:
             print("Warning: No pose detected. Using fallback/mock measurements for testing.")
-            # For testing/MVP robustness, return estimated based on height alone
-            # Standard human ratios
-            return {
-                "measurements": {
-                    "thobe_length": round(true_height_cm * 0.8, 1),
-                    "shoulder_width": round(true_height_cm * 0.25, 1),
-                    "sleeve_length": round(true_height_cm * 0.35, 1),
-                    "chest_circumference": round(true_height_cm * 0.55, 1),
-                    "neck_circumference": 40.0,
-                    "wrist_circumference": 18.0
-                },
-                "fit_type": fit_type,
-                "note": "Estimated from height (No pose detected)"
-            }
+            return self._fallback_estimate(true_height_cm, fit_type)
             # raise ValueError("No pose detected in image")
 
-        landmarks = results.pose_landmarks.landmark
+        return self._measure(points, image_width, image_height, true_height_cm, fit_type, mask)
+
+    def process_frames(self, frames, true_height_cm: float, fit_type: str = "Standard", deadline=None):
+        """
+        Measures from a burst of frames or a short clip.
+
+        `frames` is consumed lazily (e.g. iter_video_frames) and only the
+        landmarks of each frame are kept, so the clip is never held in memory.
+        Landmarks are aggregated with a per-landmark median over the frames in
+        which they are visible.
+        """
+        samples = []
+        mask = None
+        image_width = image_height = None
+        frame_count = 0
+
+        with self.tracking_pose() as pose:
+            for frame in frames:
+                check_deadline(deadline, "inference")
+                frame_count += 1
+                height, width = frame.shape[:2]
+                if image_width is None:
+                    image_width, image_height = width, height
+                elif (width, height) != (image_width, image_height):
+                    print(f"Warning: Skipping burst frame with mismatched size {width}x{height}")
+                    continue
+
+                results = pose.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                if not results.pose_landmarks:
+                    continue
+                samples.append([(lm.x, lm.y, lm.visibility) for lm in results.pose_landmarks.landmark])
+                if self.enable_mask_analysis and results.segmentation_mask is not None:
+                    # The graph reuses its output buffer on the next frame
+                    mask = np.array(results.segmentation_mask, copy=True)
 
+        if frame_count == 0:
+            raise ValueError("No frames could be decoded")
+        if not samples:
+            print("Warning: No pose detected in any frame. Using fallback/mock measurements for testing.")
+            return self._fallback_estimate(true_height_cm, fit_type)
+
+        points, spread = self.aggregate_landmarks(np.array(samples))
+        result = self._measure(points, image_width, image_height, true_height_cm, fit_type, mask)
+        result["debug"]["frames_total"] = frame_count
+        result["debug"]["frames_with_pose"] = len(samples)
+        result["debug"]["landmark_spread_px"] = round(float(np.median(spread) * max(image_width, image_height)), 2)
+        return result
+
+    @staticmethod
+    def aggregate_landmarks(samples, min_visibility: float = MIN_LANDMARK_VISIBILITY):
+        """
+        Robust per-landmark aggregate of an (n_frames, 33, 3) array of x, y, visibility.
+
+        Returns (points, spread): the median (x, y) per landmark, ignoring frames
+        where it was not visible (all frames if it never was), and the median
+        absolute deviation of those positions.
+        """
+        xy = samples[:, :, :2]
+        visible = samples[:, :, 2:3] >= min_visibility
+        # Landmarks never visible fall back to every frame
+        visible = visible | ~visible.any(axis=0, keepdims=True)
+        masked = np.where(visible, xy, np.nan)
+
+        points = np.nanmedian(masked, axis=0)
+        spread = np.nanmedian(np.abs(masked - points), axis=0).max(axis=1)
+        return points, spread
+
+    def _measure(self, points, image_width: int, image_height: int, true_height_cm: float, fit_type: str, mask=None):
         # Get key landmark coordinates (normalized 0-1)
         # 11: left_shoulder, 12: right_shoulder
         # 23: left_hip, 24: right_hip
@@ -68,7 +313,7 @@ class Cutter:
         # 0: nose, 7: left_ear, 8: right_ear
 
         def get_pt(idx):
-            return (landmarks[idx].x * image_width, landmarks[idx].y * image_height)
+            return (points[idx][0] * image_width, points[idx][1] * image_height)
 
         l_shoulder = get_pt(11)
         r_shoulder = get_pt(12)
@@ -81,6 +326,8 @@ class Cutter:
         nose = get_pt(0)
         l_ear = get_pt(7)
         r_ear = get_pt(8)
+        l_hip = get_pt(23)
+        r_hip = get_pt(24)
 
         # --- 1. Height Calibration ---
         # Estimate Head Top: Use nose and ears to guess top of head (approx)
@@ -139,6 +386,36 @@ class Cutter:
         chest_width = dist(l_shoulder, r_shoulder) # Using shoulder width as proxy for chest width at wide point?
         chest_circ_raw = chest_width * 2.2 # Heuristic.
 
+        # Optional: read real torso widths from the segmentation mask instead
+        body_profile = None
+        mask_elapsed_ms = None
+        if self.enable_mask_analysis and mask is not None:
+            start = time.perf_counter()
+            mid_hip = ((l_hip[0] + r_hip[0])/2, (l_hip[1] + r_hip[1])/2)
+            center_x = (mid_shoulder[0] + mid_hip[0]) / 2
+            profile = self.body_width_profile(mask, center_x)
+
+            # Landmark-derived heights along the torso (shoulder line -> hip line)
+            torso = mid_hip[1] - mid_shoulder[1]
+            chest_px = self.width_at(profile, mid_shoulder[1] + torso * 0.3)
+            waist_px = self.width_at(profile, mid_shoulder[1] + torso * 0.75)
+            hip_px = self.width_at(profile, mid_hip[1])
+
+            mask_elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+            if mask_elapsed_ms > MASK_STAGE_BUDGET_MS:
+                print(f"Warning: Mask analysis took {mask_elapsed_ms}ms (budget {MASK_STAGE_BUDGET_MS}ms). Using shoulder-width proxy.")
+            else:
+                body_profile = {
+                    "chest_width": round(chest_px / pixels_per_cm, 1),
+                    "waist_width": round(waist_px / pixels_per_cm, 1),
+                    "hip_width": round(hip_px / pixels_per_cm, 1),
+                    "chest_circumference": round(self.ellipse_circumference(chest_px / pixels_per_cm), 1),
+                    "waist_circumference": round(self.ellipse_circumference(waist_px / pixels_per_cm), 1),
+                    "hip_circumference": round(self.ellipse_circumference(hip_px / pixels_per_cm), 1)
+                }
+                if chest_px > 0:
+                    chest_circ_raw = self.ellipse_circumference(chest_px / pixels_per_cm)
+
         # --- 3. Ease Logic (Thoub Specific) ---
         # Rule: Final Chest = Raw + Ease (10-12 Std, 6-8 Slim)
         # Rule: Final Length = Body Length + NeckHeight? - 1cm
@@ -155,7 +432,7 @@ class Cutter:
         # And subtract 1cm for "no drag".
         final_length = (body_length + 2.0) - 1.0
 
-        return {
+        result = {
             "measurements": {
                 "shoulder_width": round(shoulder_width, 1),
                 "sleeve_length": round(final_sleeve, 1),
@@ -170,3 +447,8 @@ class Cutter:
                 "raw_height_pixels": person_pixel_height
             }
         }
+        if mask_elapsed_ms is not None:
+            result["debug"]["mask_analysis_ms"] = mask_elapsed_ms
+        if body_profile:
+            result["body_profile"] = body_profile
+        return result
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+MEASURE_TIMEOUT = float(os.getenv("THOUB_MEASURE_TIMEOUT", "60"))
+TRY_ON_TIMEOUT = float(os.getenv("THOUB_TRY_ON_TIMEOUT", "120"))
+# Clients may ask for a shorter (never longer) budget with this header, in seconds
+TIMEOUT_HEADER = "X-Request-Timeout"
+DISCONNECT_POLL_INTERVAL = 0.5
+
+_stats_lock = threading.Lock()
+_abandoned = Counter()
+
+class RequestCancelled(Exception):
+    """Raised at a stage boundary when the deadline passed or the client went away."""
+
+    def __init__(self, reason: str, stage: str):
+        super().__init__(f"Request {reason} before {stage}")
+        self.reason = reason
+        self.stage = stage
+
+def cancellation_stats():
+    """Abandoned work so far, keyed by "<reason>:<stage>"."""
+    with _stats_lock:
+        counts = dict(_abandoned)
+    return {"total": sum(counts.values()), "by_stage": counts}
+
+class Deadline:
+    """
+    Time budget for one request, checked between pipeline stages.
+
+    Thread-safe: the endpoint's disconnect watcher marks it cancelled while
+    the pipeline runs in a worker thread and calls check().
+    """
+
+    def __init__(self, timeout: float):
+        self.expires_at = time.monotonic() + timeout
+        self._cancelled = threading.Event()
+        self._counted = False
+
+    @classmethod
+    def for_request(cls, request, default_timeout: float):
+        timeout = default_timeout
+        requested = request.headers.get(TIMEOUT_HEADER)
+        if requested:
+            try:
+                timeout = min(default_timeout, max(0.0, float(requested)))
+            except ValueError:
+                pass
+        return cls(timeout)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self, stage: str):
+        if self.cancelled:
+            reason = "disconnected"
+        elif time.monotonic() >= self.expires_at:
+            reason = "expired"
+        else:
+            return
+        self._record(reason, stage)
+        print(f"DEBUG: Abandoning request ({reason}) before {stage}")
+        raise RequestCancelled(reason, stage)
+
+    def abandon(self, stage: str):
+        """Cancels from the outside (e.g. a dropped stream) and counts it if nothing has yet."""
+        self.cancel()
+        self._record("disconnected", stage)
+
+    def _record(self, reason: str, stage: str):
+        # Each request is counted once, whichever side notices first
+        with _stats_lock:
+            if self._counted:
+                return
+            self._counted = True
+            _abandoned[f"{reason}:{stage}"] += 1
+
+    def sleep(self, seconds: float, stage: str = "retry"):
+        """Sleeps up to `seconds`, waking early (and raising) on cancellation or expiry."""
+        self.check(stage)
+        self._cancelled.wait(min(seconds, self.remaining()))
+        self.check(stage)
+
+def start_request_deadline(request, default_timeout: float):
+    """
+    Creates the request's Deadline and a task watching for client disconnects.
+    Callers must cancel the returned task when the request finishes.
+    """
+    deadline = Deadline.for_request(request, default_timeout)
+    watcher = asyncio.ensure_future(watch_disconnect(request, deadline))
+    return deadline, watcher
+
+async def watch_disconnect(request, deadline: Deadline, interval: float = DISCONNECT_POLL_INTERVAL):
+    """Cancels `deadline` once the client disconnects. Run as a task for the request's lifetime."""
+    while not deadline.cancelled:
+        if await request.is_disconnected():
+            deadline.cancel()
+            return
+        await asyncio.sleep(interval)
+
+def status_for(cancelled: RequestCancelled) -> int:
+    # 499: client closed request (nginx convention); 504 when our own budget ran out
+    return 499 if cancelled.reason == "disconnected" else 504
+
+def check_deadline(deadline: Optional[Deadline], stage: str):
+    """Convenience for code paths where the deadline is optional."""
+    if deadline is not None:
+        deadline.check(stage)
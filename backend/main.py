@@ -1,14 +1,25 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from typing import List, Optional
 # from cutter import Cutter (Moved to lazy loader)
 # from virtual_mirror import NeuralMirror (Moved to lazy loader)
 import traceback
+import io
+import json
 import os
-import shutil
 from utils import convert_heic_to_jpg
+from memory_budget import (
+    MAX_UPLOAD_BYTES, MAX_REQUEST_UPLOAD_BYTES, REQUEST_DECODE_BUDGET, MEASURE_BYTES_PER_PIXEL,
+    CONVERT_BYTES_PER_PIXEL, MULTIPART_OVERHEAD_BYTES, BudgetExhausted, UnreadableImage, UploadTooLarge, decode_budget,
+    image_pixels, reduce_factor_for, save_upload
+)
+from deadline import (
+    MEASURE_TIMEOUT, TRY_ON_TIMEOUT, RequestCancelled,
+    cancellation_stats, check_deadline, start_request_deadline, status_for
+)
+from style_catalog import InvalidStyleError, get_catalog, reload_catalog
 from supabase import create_client, Client
 import requests
 
@@ -40,6 +51,7 @@ origins = [
 ]
 
 from fastapi import Request
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 import time
 
 @app.middleware("http")
@@ -55,6 +67,42 @@ async def log_requests(request: Request, call_next):
         print(f"DEBUG: Request failed: {e}")
         raise
 
+class RequestSizeLimitMiddleware:
+    """
+    Rejects request bodies over `max_bytes` before form parsing spools them:
+    up front from Content-Length, and while streaming for chunked uploads.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        detail = f"Request body exceeds the {self.max_bytes // (1024 * 1024)} MB limit"
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": detail})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+# Added before CORS so 413 responses still carry CORS headers
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=MAX_REQUEST_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -91,11 +139,14 @@ async def heartbeat():
 @app.on_event("startup")
 async def startup_event():
     print(f"DEBUG: Starting application on PORT: {os.getenv('PORT')}")
+    # Build every style prompt once up front
+    get_catalog()
     # Start heartbeat
     asyncio.create_task(heartbeat())
 
 _cutter_service = None
 _mirror_service = None
+_result_store = None
 
 def get_cutter_service():
     global _cutter_service
@@ -111,6 +162,22 @@ def get_mirror_service():
         _mirror_service = NeuralMirror()
     return _mirror_service
 
+def get_result_store():
+    global _result_store
+    if _result_store is None:
+        try:
+            from store import ResultStore
+            _result_store = ResultStore()
+        except Exception as e:
+            print(f"FAILED TO INITIALIZE RESULT STORE: {e}")
+    return _result_store
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Flush batched writes before exiting
+    if _result_store:
+        _result_store.close()
+
 @app.get("/")
 def read_root():
     return {
@@ -124,62 +191,119 @@ def ping():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "abandoned_requests": cancellation_stats(),
+        "image_memory": decode_budget.stats()
+    }
+
+def run_within_budget(nbytes: int, func, *args, **kwargs):
+    """Runs func once `nbytes` of the decode budget is free (blocks; call via run_in_threadpool)."""
+    with decode_budget.reserve(nbytes):
+        return func(*args, **kwargs)
+
+async def save_and_convert(upload: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES, deadline=None):
+    """
+    Saves an upload under uploads/ and converts HEIC to JPG within the decode
+    budget. Returns (local_path, uploaded_size).
+    """
+    check_deadline(deadline, "upload")
+    path = f"uploads/{upload.filename}"
+    size = save_upload(upload, path, min(max_bytes, MAX_UPLOAD_BYTES))
+    if os.path.splitext(path)[1].lower() in ['.heic', '.heif']:
+        path = await run_in_threadpool(
+            run_within_budget, image_pixels(path) * CONVERT_BYTES_PER_PIXEL, convert_heic_to_jpg, path
+        )
+    return path, size
+
+def checked_frames(uploads):
+    """
+    Reads burst frames one at a time. Frames whose header is unreadable are
+    skipped (like undecodable ones); frames over the pixel cap reject the request.
+    """
+    for i, upload in enumerate(uploads):
+        content = upload.file.read()
+        try:
+            image_pixels(io.BytesIO(content))
+        except UnreadableImage:
+            print(f"Warning: Skipping burst frame {i} with unreadable header")
+            continue
+        yield content
+
+def budget_exhausted_error(e: BudgetExhausted):
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
 
 @app.post("/measure")
 async def measure_body(
+    request: Request,
     front_image: UploadFile = File(...),
     side_image: Optional[UploadFile] = File(None),
     profile_image: UploadFile = File(...),
     height_cm: float = Form(...),
     fit_type: str = Form("Standard"),
+    user_id: Optional[str] = Form(None),
     api_key: str = Depends(get_api_key)
 ):
+    deadline, watcher = start_request_deadline(request, MEASURE_TIMEOUT)
     try:
         # Create uploads directory
         os.makedirs("uploads", exist_ok=True)
         
-        # Save Front Image
-        front_path = f"uploads/{front_image.filename}"
-        with open(front_path, "wb") as buffer:
-            shutil.copyfileobj(front_image.file, buffer)
-        
-        # Convert HEIC to JPG if necessary
-        front_path = convert_heic_to_jpg(front_path)
+        # Save images, with the per-file and per-request upload limits
+        remaining = MAX_REQUEST_UPLOAD_BYTES
+        front_path, size = await save_and_convert(front_image, remaining, deadline)
+        remaining -= size
         front_filename = os.path.basename(front_path)
             
         # Save Side Image if exists
         side_path = None
         side_filename = None
         if side_image:
-            side_path = f"uploads/{side_image.filename}"
-            with open(side_path, "wb") as buffer:
-                shutil.copyfileobj(side_image.file, buffer)
-            
-            # Convert HEIC to JPG if necessary
-            side_path = convert_heic_to_jpg(side_path)
+            side_path, size = await save_and_convert(side_image, remaining, deadline)
+            remaining -= size
             side_filename = os.path.basename(side_path)
 
         # Save Profile Image
-        profile_path = f"uploads/{profile_image.filename}"
-        with open(profile_path, "wb") as buffer:
-            shutil.copyfileobj(profile_image.file, buffer)
-        
-        # Convert HEIC to JPG if necessary
-        profile_path = convert_heic_to_jpg(profile_path)
+        profile_path, size = await save_and_convert(profile_image, remaining, deadline)
         profile_filename = os.path.basename(profile_path)
 
         # Process measurements
+        deadline.check("decode")
         with open(front_path, "rb") as f:
             front_content = f.read()
             
         cutter = get_cutter_service()
         if not cutter:
              raise HTTPException(status_code=503, detail="Cutter service is not available (MediaPipe initialization failed)")
-            
-        result = cutter.process(front_content, height_cm, fit_type)
+
+        # Reuse a stored result for the same image, height, fit and measurement version
+        from store import hash_bytes
+        store = get_result_store()
+        image_hash = hash_bytes(front_content)
+        result = store.find_measurement(image_hash, height_cm, fit_type, cutter.version) if store else None
+
+        if result is not None:
+            print(f"DEBUG: Measurement cache hit for {front_filename}")
+            if user_id:
+                # Still part of this customer's history
+                store.save_measurement(image_hash, height_cm, fit_type, cutter.version, result, user_id=user_id)
+            result["cached"] = True
+        else:
+            # Reserve memory for the decoded image (downscaled if it would not fit the
+            # per-request budget), off the event loop so the disconnect watcher keeps running
+            pixels = image_pixels(front_path)
+            reduce_factor = reduce_factor_for(pixels)
+            decoded_bytes = len(front_content) + pixels * MEASURE_BYTES_PER_PIXEL // (reduce_factor * reduce_factor)
+            result = await run_in_threadpool(
+                run_within_budget, decoded_bytes,
+                cutter.process, front_content, height_cm, fit_type,
+                deadline=deadline, reduce_factor=reduce_factor
+            )
+            if store:
+                store.save_measurement(image_hash, height_cm, fit_type, cutter.version, result, user_id=user_id)
         
         # 4. UPLOAD TO SUPABASE (Persistence)
+        deadline.check("storage")
         if supabase:
             try:
                 for filename, path in [
@@ -211,14 +335,125 @@ async def measure_body(
         
         return result
         
+    except HTTPException:
+        raise
+    except RequestCancelled as rc:
+        raise HTTPException(status_code=status_for(rc), detail=str(rc))
+    except UploadTooLarge as ut:
+        raise HTTPException(status_code=413, detail=str(ut))
+    except BudgetExhausted as be:
+        raise budget_exhausted_error(be)
+    except ValueError as ve:
+        raise HTTPException(status_code=422, detail=str(ve))
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+    finally:
+        watcher.cancel()
+
+@app.post("/measure-burst")
+async def measure_burst(
+    request: Request,
+    video: Optional[UploadFile] = File(None),
+    frames: Optional[List[UploadFile]] = File(None),
+    height_cm: float = Form(...),
+    fit_type: str = Form("Standard"),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Measures from a short clip or a burst of frames. Pose runs in tracking
+    mode and landmarks are aggregated across frames for steadier results.
+    """
+    if not video and not frames:
+        raise HTTPException(status_code=422, detail="Provide either a video or a burst of frames")
+
+    video_path = None
+    deadline, watcher = start_request_deadline(request, MEASURE_TIMEOUT)
+    try:
+        from cutter import iter_video_frames, iter_image_frames, video_frame_pixels
+
+        cutter = get_cutter_service()
+        if not cutter:
+             raise HTTPException(status_code=503, detail="Cutter service is not available (MediaPipe initialization failed)")
+
+        if video:
+            # OpenCV needs a file to read from; stream the upload to disk in chunks
+            os.makedirs("uploads", exist_ok=True)
+            video_path = f"uploads/burst_{int(time.time() * 1000)}_{os.path.basename(video.filename or 'clip')}"
+            save_upload(video, video_path, MAX_REQUEST_UPLOAD_BYTES)
+            # Frames are decoded one at a time, so one frame's worth of budget is enough
+            reservation = await run_in_threadpool(video_frame_pixels, video_path) * MEASURE_BYTES_PER_PIXEL
+            frame_source = iter_video_frames(video_path)
+        else:
+            # Read each frame only when the generator asks for it
+            if sum(f.size or 0 for f in frames) > MAX_REQUEST_UPLOAD_BYTES:
+                raise UploadTooLarge(f"Burst exceeds the {MAX_REQUEST_UPLOAD_BYTES // (1024 * 1024)} MB upload limit")
+            # Frame sizes are only known as each one is read; hold one request's worth of budget
+            reservation = REQUEST_DECODE_BUDGET
+            frame_source = iter_image_frames(checked_frames(frames))
+
+        return await run_in_threadpool(
+            run_within_budget, reservation,
+            cutter.process_frames, frame_source, height_cm, fit_type, deadline=deadline
+        )
+
+    except HTTPException:
+        raise
+    except RequestCancelled as rc:
+        raise HTTPException(status_code=status_for(rc), detail=str(rc))
+    except UploadTooLarge as ut:
+        raise HTTPException(status_code=413, detail=str(ut))
+    except BudgetExhausted as be:
+        raise budget_exhausted_error(be)
     except ValueError as ve:
         raise HTTPException(status_code=422, detail=str(ve))
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+    finally:
+        watcher.cancel()
+        if video_path and os.path.exists(video_path):
+            os.remove(video_path)
+
+def resolve_style(texture_id: str, pattern_id: str, style_config: str, closure_type: str, has_pocket: bool):
+    """Returns (StyleChoice, None), or (None, JSONResponse) for ids not in the catalog."""
+    try:
+        return get_catalog().resolve(texture_id, pattern_id, style_config, closure_type, has_pocket), None
+    except InvalidStyleError as ie:
+        return None, JSONResponse(status_code=422, content={"error": str(ie), "invalid": ie.errors})
+
+def fetch_profile_image(profile_image_id: str):
+    """
+    Returns (local_path, None), downloading the image from Supabase if it is
+    not on disk, or (None, JSONResponse) when it cannot be found.
+    """
+    image_path = f"uploads/{profile_image_id}"
+        
+    # If not local, try fetching from Supabase
+    if not os.path.exists(image_path):
+        if supabase:
+            try:
+                print(f"DEBUG: Image not found locally, fetching {profile_image_id} from Supabase...")
+                res = supabase.storage.from_(SUPABASE_BUCKET).download(profile_image_id)
+                os.makedirs("uploads", exist_ok=True)
+                with open(image_path, "wb") as f:
+                    f.write(res)
+                print(f"DEBUG: Successfully downloaded {profile_image_id} from Supabase")
+            except Exception as se:
+                print(f"DEBUG: Failed to download from Supabase: {se}")
+                # If download fails, we can't proceed with Gemini
+                return None, JSONResponse(status_code=404, content={"error": f"Image {profile_image_id} not found locally or in cloud storage."})
+        else:
+            return None, JSONResponse(status_code=404, content={"error": f"Image {profile_image_id} not found locally and Supabase is not configured."})
+        
+    if not os.path.exists(image_path):
+         return None, JSONResponse(status_code=404, content={"error": f"Image not found at {image_path}"})
+
+    return image_path, None
 
 @app.post("/try-on")
 async def try_on(
+    request: Request,
     profile_image_id: str = Form(...),
     texture_id: str = Form(...),
     pattern_id: str = Form("solid"),
@@ -226,31 +461,35 @@ async def try_on(
     closure_type: str = Form("buttons"),
     has_pocket: bool = Form(True),
     extra_details: str = Form(""),
+    user_id: Optional[str] = Form(None),
+    regenerate: bool = Form(False),
     api_key: str = Depends(get_api_key)
 ):
+    # Reject unknown style ids before spending any network calls
+    choice, error = resolve_style(texture_id, pattern_id, style_config, closure_type, has_pocket)
+    if error:
+        return error
+
+    deadline, watcher = start_request_deadline(request, TRY_ON_TIMEOUT)
     try:
-        image_path = f"uploads/{profile_image_id}"
-        
-        # If not local, try fetching from Supabase
-        if not os.path.exists(image_path):
-            if supabase:
-                try:
-                    print(f"DEBUG: Image not found locally, fetching {profile_image_id} from Supabase...")
-                    res = supabase.storage.from_(SUPABASE_BUCKET).download(profile_image_id)
-                    os.makedirs("uploads", exist_ok=True)
-                    with open(image_path, "wb") as f:
-                        f.write(res)
-                    print(f"DEBUG: Successfully downloaded {profile_image_id} from Supabase")
-                except Exception as se:
-                    print(f"DEBUG: Failed to download from Supabase: {se}")
-                    # If download fails, we can't proceed with Gemini
-                    return JSONResponse(status_code=404, content={"error": f"Image {profile_image_id} not found locally or in cloud storage."})
-            else:
-                return JSONResponse(status_code=404, content={"error": f"Image {profile_image_id} not found locally and Supabase is not configured."})
-        
-        if not os.path.exists(image_path):
-             return JSONResponse(status_code=404, content={"error": f"Image not found at {image_path}"})
+        # Blocking download, hashing and lookup, kept off the event loop
+        image_path, error = await run_in_threadpool(fetch_profile_image, profile_image_id)
+        if error:
+            return error
         
+        # Return an existing render for this image and style unless asked to regenerate
+        from store import hash_file
+        store = get_result_store()
+        image_hash = await run_in_threadpool(hash_file, image_path)
+        render_key = choice.cache_key(extra_details)
+        if store and not regenerate:
+            cached = await run_in_threadpool(store.find_render, image_hash, render_key)
+            if cached:
+                print(f"DEBUG: Render cache hit for {profile_image_id}")
+                if user_id:
+                    store.save_render(image_hash, render_key, cached["image_url"], cached.get("description", ""), user_id=user_id, image_id=profile_image_id)
+                return {**cached, "cached": True}
+
         # Call Neural Mirror (Gemini)
         # Note: image_path needs to be absolute for some SDKs, or relative is fine.
         # virtual_mirror.py uses it directly.
@@ -259,24 +498,144 @@ async def try_on(
         if not mirror:
              return JSONResponse(status_code=503, content={"error": "Neural Mirror service is not available (Gemini initialization failed)"})
 
-        result = mirror.generate_try_on(
+        result = await run_in_threadpool(
+            mirror.generate_try_on,
             image_path, 
-            texture_id, 
-            pattern_id, 
-            style_config, 
-            closure_type, 
-            has_pocket, 
+            choice,
             extra_details,
             profile_image_id,
             supabase_client=supabase,
-            bucket_name=SUPABASE_BUCKET
+            bucket_name=SUPABASE_BUCKET,
+            deadline=deadline
         ) # Updated to pass all new params
+
+        # Only real renders are worth remembering (not errors or the mock image)
+        if store and mirror.model and result.get("image_url") and not result.get("error"):
+            store.save_render(
+                image_hash,
+                render_key,
+                result["image_url"],
+                result.get("description", ""),
+                user_id=user_id,
+                image_id=profile_image_id
+            )
         
         return result
 
+    except RequestCancelled as rc:
+        return JSONResponse(status_code=status_for(rc), content={"error": str(rc)})
     except Exception as e:
         print(f"Error in try-on: {e}") # Changed error logging
         return JSONResponse(status_code=500, content={"error": str(e)}) # Changed to JSONResponse
+    finally:
+        watcher.cancel()
+
+@app.post("/try-on/stream")
+async def try_on_stream(
+    request: Request,
+    profile_image_id: str = Form(...),
+    texture_id: str = Form(...),
+    pattern_id: str = Form("solid"),
+    style_config: str = Form(...),
+    closure_type: str = Form("buttons"),
+    has_pocket: bool = Form(True),
+    extra_details: str = Form(""),
+    user_id: Optional[str] = Form(None),
+    regenerate: bool = Form(False),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Same as /try-on, but streams newline-delimited JSON events (text, image
+    bytes, then the stored URL) while the render is being generated.
+    """
+    choice, error = resolve_style(texture_id, pattern_id, style_config, closure_type, has_pocket)
+    if error:
+        return error
+
+    try:
+        # Blocking download and hashing, kept off the event loop
+        image_path, error = await run_in_threadpool(fetch_profile_image, profile_image_id)
+        if error:
+            return error
+
+        from store import hash_file
+        store = get_result_store()
+        image_hash = await run_in_threadpool(hash_file, image_path)
+        render_key = choice.cache_key(extra_details)
+        cached = None
+        if store and not regenerate:
+            cached = await run_in_threadpool(store.find_render, image_hash, render_key)
+
+        mirror = None
+        if not cached:
+            mirror = get_mirror_service()
+            if not mirror:
+                 return JSONResponse(status_code=503, content={"error": "Neural Mirror service is not available (Gemini initialization failed)"})
+    except Exception as e:
+        print(f"Error in try-on stream: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    deadline, watcher = start_request_deadline(request, TRY_ON_TIMEOUT)
+
+    async def event_stream():
+        try:
+            if cached:
+                print(f"DEBUG: Render cache hit for {profile_image_id}")
+                if user_id:
+                    store.save_render(image_hash, render_key, cached["image_url"], cached.get("description", ""), user_id=user_id, image_id=profile_image_id)
+                yield json.dumps({"type": "stored", **cached, "cached": True}) + "\n"
+                return
+
+            events = mirror.stream_try_on(
+                image_path,
+                choice,
+                extra_details,
+                profile_image_id,
+                supabase_client=supabase,
+                bucket_name=SUPABASE_BUCKET,
+                deadline=deadline
+            )
+            async for event in iterate_in_threadpool(events):
+                if store and mirror.model and event["type"] == "stored":
+                    store.save_render(
+                        image_hash,
+                        render_key,
+                        event["image_url"],
+                        event.get("description", ""),
+                        user_id=user_id,
+                        image_id=profile_image_id
+                    )
+                yield json.dumps(event) + "\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away mid-stream: stop the generation thread and count it
+            deadline.abandon("stream")
+            raise
+        finally:
+            watcher.cancel()
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+@app.get("/catalog")
+def get_style_catalog():
+    return get_catalog().describe()
+
+@app.post("/catalog/reload")
+def reload_style_catalog(api_key: str = Depends(get_api_key)):
+    try:
+        return reload_catalog().describe()
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Style catalog not reloaded: {e}")
+
+@app.get("/history/{user_id}")
+def get_history(
+    user_id: str,
+    limit: int = 20,
+    api_key: str = Depends(get_api_key)
+):
+    store = get_result_store()
+    if not store:
+        raise HTTPException(status_code=503, detail="Result store is not available")
+    return store.history(user_id, limit=max(1, min(limit, 100)))
 
 @app.post("/upload-image")
 async def upload_image(
@@ -285,13 +644,9 @@ async def upload_image(
 ):
     try:
         # Save Image locally first for conversion
-        local_path = f"uploads/{image.filename}"
         os.makedirs("uploads", exist_ok=True)
-        with open(local_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-        
         # Convert HEIC to JPG if necessary
-        local_path = convert_heic_to_jpg(local_path)
+        local_path, _ = await save_and_convert(image)
         filename = os.path.basename(local_path)
         
         # Upload to Supabase if configured
@@ -310,6 +665,12 @@ async def upload_image(
             "filename": filename,
             "url": public_url
         }
+    except UploadTooLarge as ut:
+        raise HTTPException(status_code=413, detail=str(ut))
+    except BudgetExhausted as be:
+        raise budget_exhausted_error(be)
+    except ValueError as ve:
+        raise HTTPException(status_code=422, detail=str(ve))
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
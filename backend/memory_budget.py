@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+MB = 1024 * 1024
+
+# Largest single uploaded file, and all files of one request together
+MAX_UPLOAD_BYTES = int(float(os.getenv("THOUB_MAX_UPLOAD_MB", "40")) * MB)
+MAX_REQUEST_UPLOAD_BYTES = int(float(os.getenv("THOUB_MAX_REQUEST_UPLOAD_MB", "100")) * MB)
+# Allowance for multipart boundaries and form fields on top of the files themselves
+MULTIPART_OVERHEAD_BYTES = MB
+# Images whose header declares more pixels than this are rejected before decoding
+MAX_IMAGE_PIXELS = int(float(os.getenv("THOUB_MAX_IMAGE_MEGAPIXELS", "50")) * 1000 * 1000)
+
+# Decoded image data held in memory: by one request, and by all requests at once
+REQUEST_DECODE_BUDGET = int(float(os.getenv("THOUB_REQUEST_DECODE_MB", "128")) * MB)
+GLOBAL_DECODE_BUDGET = int(float(os.getenv("THOUB_DECODE_BUDGET_MB", "512")) * MB)
+# How long a request waits for budget before it is turned away with a 503
+BUDGET_WAIT_SECONDS = float(os.getenv("THOUB_BUDGET_WAIT_SECONDS", "10"))
+
+# Bytes per pixel while measuring: BGR decode + RGB copy + float32 segmentation
+# mask, plus headroom for MediaPipe's own buffers
+MEASURE_BYTES_PER_PIXEL = 16
+# Bytes per pixel for a HEIC -> JPEG conversion: decoded RGB + converted copy
+CONVERT_BYTES_PER_PIXEL = 6
+
+CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+class BudgetExhausted(Exception):
+    pass
+
+class UnreadableImage(ValueError):
+    pass
+
+class MemoryBudget:
+    """
+    Counting semaphore over bytes of in-flight decoded image data.
+
+    reserve() blocks while the budget is used up, for at most `wait` seconds,
+    then raises BudgetExhausted so the caller can shed load.
+    """
+
+    def __init__(self, limit: int, wait: float = BUDGET_WAIT_SECONDS):
+        self.limit = limit
+        self.wait = wait
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        # A single reservation never needs more than the whole budget
+        nbytes = min(int(nbytes), self.limit)
+        deadline = time.monotonic() + self.wait
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_use + nbytes > self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise BudgetExhausted(f"Image memory budget exhausted ({self.in_use // MB} MB in use)")
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield nbytes
+        finally:
+            with self._cond:
+                self.in_use -= nbytes
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "in_use_mb": round(self.in_use / MB, 1),
+                "peak_mb": round(self.peak / MB, 1),
+                "limit_mb": round(self.limit / MB, 1),
+                "waiting": self.waiting,
+                "rejected": self.rejected
+            }
+
+decode_budget = MemoryBudget(GLOBAL_DECODE_BUDGET)
+
+def save_upload(upload_file, dest_path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> int:
+    """
+    Streams an UploadFile to `dest_path` in chunks and returns its size.
+    Raises UploadTooLarge (and removes the partial file) past `max_bytes`.
+    """
+    written = 0
+    with open(dest_path, "wb") as buffer:
+        while True:
+            chunk = upload_file.file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > max_bytes:
+                break
+            buffer.write(chunk)
+    if written > max_bytes:
+        os.remove(dest_path)
+        raise UploadTooLarge(f"{upload_file.filename} exceeds the {max_bytes // MB} MB upload limit")
+    return written
+
+def image_pixels(source, max_pixels: int = MAX_IMAGE_PIXELS) -> int:
+    """
+    Pixel count from the image header (path or file-like), without decoding.
+
+    Raises UnreadableImage if the header cannot be read and UploadTooLarge past
+    `max_pixels`, so no caller ever decodes an image of unknown size.
+    """
+    from PIL import Image
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise UploadTooLarge(f"Image exceeds the {max_pixels // 1000000} megapixel limit")
+    except Exception as e:
+        raise UnreadableImage(f"Could not read image header: {e}")
+    pixels = width * height
+    if pixels > max_pixels:
+        raise UploadTooLarge(f"Image is {width}x{height}, over the {max_pixels // 1000000} megapixel limit")
+    return pixels
+
+def reduce_factor_for(pixels: int, bytes_per_pixel: int = MEASURE_BYTES_PER_PIXEL, budget: int = REQUEST_DECODE_BUDGET) -> int:
+    """Smallest of 1, 2, 4, 8 such that decoding at 1/factor scale fits the per-request budget."""
+    for factor in (1, 2, 4):
+        if pixels * bytes_per_pixel / (factor * factor) <= budget:
+            return factor
+    return 8
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+STORE_PATH = os.getenv("THOUB_STORE_PATH", "thoub_store.db")
+# Writer thread commits when this many writes are pending or after FLUSH_INTERVAL seconds
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_hash TEXT NOT NULL,
+    user_id TEXT,
+    height_cm REAL NOT NULL,
+    fit_type TEXT NOT NULL,
+    version TEXT NOT NULL DEFAULT '',
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_measurements_user ON measurements (user_id, created_at);
+
+CREATE TABLE IF NOT EXISTS renders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_hash TEXT NOT NULL,
+    style_key TEXT NOT NULL,
+    user_id TEXT,
+    image_id TEXT,
+    image_url TEXT NOT NULL,
+    description TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_renders_lookup ON renders (image_hash, style_key);
+CREATE INDEX IF NOT EXISTS idx_renders_user ON renders (user_id, created_at);
+"""
+
+def hash_bytes(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ResultStore:
+    """
+    Local SQLite (WAL) store for measurement results and try-on renders.
+
+    Lookups run on the calling thread with a per-thread connection. Writes are
+    queued and committed in batches by a background thread, so a result saved
+    by one request becomes visible to lookups shortly after, not immediately.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._closed = False
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        # Databases created before measurements were versioned
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(measurements)")]
+        if "version" not in columns:
+            conn.execute("ALTER TABLE measurements ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+        conn.execute("DROP INDEX IF EXISTS idx_measurements_lookup")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_version_lookup ON measurements (image_hash, height_cm, fit_type, version)")
+        conn.commit()
+        conn.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name="result-store-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    # --- Writes (batched, off the request path) ---
+
+    def _write_loop(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                stop = True
+                batch = [item for item in batch if item is not None]
+            try:
+                with conn:
+                    for sql, params in batch:
+                        conn.execute(sql, params)
+            except Exception as e:
+                print(f"Warning: Result store write failed ({len(batch)} rows dropped): {e}")
+        conn.close()
+
+    def save_measurement(self, image_hash: str, height_cm: float, fit_type: str, version: str, result: dict, user_id: Optional[str] = None):
+        """`version` identifies the measurement code and config that produced `result`."""
+        self._queue.put((
+            "INSERT INTO measurements (image_hash, user_id, height_cm, fit_type, version, result, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (image_hash, user_id, float(height_cm), fit_type, version, json.dumps(result), time.time())
+        ))
+
+    def save_render(self, image_hash: str, style: str, image_url: str, description: str = "", user_id: Optional[str] = None, image_id: Optional[str] = None):
+        self._queue.put((
+            "INSERT INTO renders (image_hash, style_key, user_id, image_id, image_url, description, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (image_hash, style, user_id, image_id, image_url, description, time.time())
+        ))
+
+    def close(self):
+        """Flushes pending writes and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+
+    # --- Reads ---
+
+    def find_measurement(self, image_hash: str, height_cm: float, fit_type: str, version: str):
+        row = self._conn.execute(
+            "SELECT result FROM measurements WHERE image_hash = ? AND height_cm = ? AND fit_type = ? AND version = ? ORDER BY created_at DESC LIMIT 1",
+            (image_hash, float(height_cm), fit_type, version)
+        ).fetchone()
+        return json.loads(row["result"]) if row else None
+
+    def find_render(self, image_hash: str, style: str):
+        row = self._conn.execute(
+            "SELECT image_url, description FROM renders WHERE image_hash = ? AND style_key = ? ORDER BY created_at DESC LIMIT 1",
+            (image_hash, style)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def history(self, user_id: str, limit: int = 20):
+        measurements = self._conn.execute(
+            "SELECT height_cm, fit_type, result, created_at FROM measurements WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        renders = self._conn.execute(
+            "SELECT image_id, style_key, image_url, description, created_at FROM renders WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        return {
+            "measurements": [
+                {**dict(row), "result": json.loads(row["result"])} for row in measurements
+            ],
+            "renders": [dict(row) for row in renders]
+        }
@@ -0,0 +1,159 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+
+CATALOG_PATH = os.getenv(
+    "THOUB_STYLE_CATALOG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "style_catalog.json")
+)
+# How often get_catalog() looks at the catalog file's mtime for hot reload
+RELOAD_CHECK_INTERVAL = 5.0
+
+SECTIONS = ("textures", "patterns", "collars", "closures")
+
+class InvalidStyleError(ValueError):
+    """Raised when a try-on request names ids that are not in the catalog."""
+
+    def __init__(self, errors: dict):
+        super().__init__("Invalid style selection: " + "; ".join(f"{k} '{v}'" for k, v in errors.items()))
+        self.errors = errors
+
+class StyleChoice:
+    """
+    A validated style combination: its canonical key, prebuilt prompt fragments
+    and the safety settings of the catalog it came from.
+    """
+
+    __slots__ = ("key", "prefix", "suffix", "safety_settings", "prompt_hash")
+
+    def __init__(self, key: str, prefix: str, suffix: str, safety_settings=()):
+        self.key = key
+        self.prefix = prefix
+        self.suffix = suffix
+        self.safety_settings = list(safety_settings)
+        # Changes when a catalog reload edits any description used by this combination
+        self.prompt_hash = hashlib.sha256((prefix + "\0" + suffix).encode()).hexdigest()[:12]
+
+    def prompt(self, extra_details: str = "") -> str:
+        return self.prefix + (extra_details or "") + self.suffix
+
+    def cache_key(self, extra_details: str = "") -> str:
+        """
+        Key for caching renders of this combination plus free-text details.
+        Includes the prompt hash, so renders made from an older catalog are not reused.
+        """
+        base = f"{self.key}:{self.prompt_hash}"
+        extra = (extra_details or "").strip()
+        if not extra:
+            return base
+        return f"{base}:{hashlib.sha256(extra.encode()).hexdigest()[:16]}"
+
+class StyleCatalog:
+    """
+    Texture, pattern, collar and closure ids with their prompt descriptions.
+
+    Every combination (including with/without pocket) is rendered to a
+    StyleChoice once at load time, so a request only does a dict lookup.
+    """
+
+    def __init__(self, data: dict, version: str = ""):
+        for section in SECTIONS:
+            entries = data.get(section)
+            if not isinstance(entries, dict) or not entries:
+                raise ValueError(f"Style catalog section '{section}' must be a non-empty object")
+            for style_id, desc in entries.items():
+                if not isinstance(desc, str) or not desc.strip():
+                    raise ValueError(f"Style catalog entry {section}.{style_id} has no description")
+
+        self.version = version
+        self.textures = dict(data["textures"])
+        self.patterns = dict(data["patterns"])
+        self.collars = dict(data["collars"])
+        self.closures = dict(data["closures"])
+        self.safety_settings = list(data.get("safety_settings", []))
+
+        self._choices = {}
+        for texture, pattern, collar, closure, has_pocket in itertools.product(
+            self.textures, self.patterns, self.collars, self.closures, (True, False)
+        ):
+            pocket_str = "with a premium chest pocket" if has_pocket else "without any chest pocket"
+            prefix = f"""
+            Input 2 (Color & Fabric): {self.textures[texture]}
+            Input 3 (Collar Architecture): {self.collars[collar]}. """
+            suffix = f"""
+            Input 4 (Weave Pattern): {self.patterns[pattern]}
+            Input 5 (Refined Details): {self.closures[closure]} closure system, {pocket_str}.
+
+            Maintain the exact proportions and features of the model in the image.
+            """
+            key = ":".join([texture, pattern, collar, closure, "pocket" if has_pocket else "no_pocket"])
+            self._choices[(texture, pattern, collar, closure, has_pocket)] = StyleChoice(key, prefix, suffix, self.safety_settings)
+
+    @classmethod
+    def load(cls, path: str = CATALOG_PATH):
+        with open(path, "rb") as f:
+            raw = f.read()
+        return cls(json.loads(raw), version=hashlib.sha256(raw).hexdigest()[:12])
+
+    def __len__(self):
+        return len(self._choices)
+
+    def resolve(self, texture_id: str, pattern_id: str, style_config: str, closure_type: str, has_pocket: bool) -> StyleChoice:
+        choice = self._choices.get((texture_id, pattern_id, style_config, closure_type, bool(has_pocket)))
+        if choice is not None:
+            return choice
+
+        errors = {}
+        for name, value, section in [
+            ("texture_id", texture_id, self.textures),
+            ("pattern_id", pattern_id, self.patterns),
+            ("style_config", style_config, self.collars),
+            ("closure_type", closure_type, self.closures)
+        ]:
+            if value not in section:
+                errors[name] = value
+        raise InvalidStyleError(errors)
+
+    def describe(self):
+        return {
+            "version": self.version,
+            "combinations": len(self),
+            **{section: sorted(getattr(self, section)) for section in SECTIONS}
+        }
+
+_catalog = None
+_catalog_mtime = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+def reload_catalog(path: str = CATALOG_PATH) -> StyleCatalog:
+    """
+    Loads the catalog from disk and swaps it in. If the new file is invalid
+    the current catalog stays active and the error is raised.
+    """
+    global _catalog, _catalog_mtime
+    with _lock:
+        mtime = os.path.getmtime(path)
+        catalog = StyleCatalog.load(path)
+        _catalog, _catalog_mtime = catalog, mtime
+    print(f"INFO: Loaded style catalog {catalog.version} ({len(catalog)} combinations)")
+    return catalog
+
+def get_catalog() -> StyleCatalog:
+    """Current catalog, reloaded automatically when the file on disk changes."""
+    global _last_check
+    if _catalog is None:
+        return reload_catalog()
+
+    now = time.monotonic()
+    if now - _last_check >= RELOAD_CHECK_INTERVAL:
+        _last_check = now
+        try:
+            if os.path.getmtime(CATALOG_PATH) != _catalog_mtime:
+                reload_catalog()
+        except Exception as e:
+            print(f"Warning: Style catalog reload failed, keeping version {_catalog.version}: {e}")
+    return _catalog
@@ -0,0 +1,25 @@
+import os
+import sys
+import pytest
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deadline import Deadline, RequestCancelled, cancellation_stats
+
+def test_deadline_cancels_and_counts_once():
+    before = cancellation_stats()["by_stage"].get("disconnected:generation", 0)
+    deadline = Deadline(60)
+    deadline.check("upload")
+    deadline.cancel()
+    for _ in range(2):
+        with pytest.raises(RequestCancelled) as exc:
+            deadline.check("generation")
+    assert exc.value.reason == "disconnected"
+    assert cancellation_stats()["by_stage"]["disconnected:generation"] == before + 1
+
+def test_deadline_sleep_stops_at_expiry():
+    deadline = Deadline(0.05)
+    with pytest.raises(RequestCancelled) as exc:
+        deadline.sleep(5, "generation")
+    assert exc.value.reason == "expired"
@@ -0,0 +1,50 @@
+import io
+import os
+import sys
+import pytest
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory_budget import (
+    BudgetExhausted, MemoryBudget, UnreadableImage, UploadTooLarge, image_pixels, reduce_factor_for, save_upload
+)
+
+def test_budget_rejects_when_exhausted_and_releases():
+    budget = MemoryBudget(100, wait=0.05)
+    with budget.reserve(80):
+        assert budget.in_use == 80
+        with pytest.raises(BudgetExhausted):
+            with budget.reserve(30):
+                pass
+    assert budget.in_use == 0
+    assert budget.rejected == 1
+    with budget.reserve(100):
+        pass
+
+def test_save_upload_enforces_limit(tmp_path):
+    class Upload:
+        filename = "big.jpg"
+        file = io.BytesIO(b"x" * 3000)
+
+    dest = tmp_path / "big.jpg"
+    with pytest.raises(UploadTooLarge):
+        save_upload(Upload(), str(dest), max_bytes=2000)
+    assert not dest.exists()
+
+def test_reduce_factor_fits_request_budget():
+    assert reduce_factor_for(1000 * 1000, bytes_per_pixel=16, budget=64 * 1024 * 1024) == 1
+    assert reduce_factor_for(4000 * 6000, bytes_per_pixel=16, budget=128 * 1024 * 1024) == 2
+
+def test_image_pixels_never_guesses_below_the_header():
+    Image = pytest.importorskip("PIL.Image")
+    png = io.BytesIO()
+    Image.new("RGB", (100, 80)).save(png, "PNG")
+
+    png.seek(0)
+    assert image_pixels(png) == 8000
+    png.seek(0)
+    with pytest.raises(UploadTooLarge):
+        image_pixels(png, max_pixels=5000)
+    with pytest.raises(UnreadableImage):
+        image_pixels(io.BytesIO(b"not an image"))
@@ -0,0 +1,39 @@
+import os
+import sys
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store import ResultStore
+
+def test_store_round_trip(tmp_path):
+    store = ResultStore(str(tmp_path / "store.db"))
+    key = "fabric_white:solid:saudi_collar:buttons:pocket"
+    store.save_measurement("abc", 180, "Standard", "2:mask=0", {"measurements": {"shoulder_width": 45.0}}, user_id="u1")
+    store.save_render("abc", key, "https://example.com/gen.png", "ok", user_id="u1", image_id="front.jpg")
+    store.close()
+
+    store = ResultStore(str(tmp_path / "store.db"))
+    assert store.find_measurement("abc", 180, "Standard", "2:mask=0")["measurements"]["shoulder_width"] == 45.0
+    assert store.find_measurement("abc", 175, "Standard", "2:mask=0") is None
+    # Results from other measurement code or config are not reused
+    assert store.find_measurement("abc", 180, "Standard", "2:mask=1") is None
+    assert store.find_render("abc", key)["image_url"] == "https://example.com/gen.png"
+
+    history = store.history("u1")
+    assert len(history["measurements"]) == 1
+    assert history["renders"][0]["image_id"] == "front.jpg"
+    store.close()
+
+def test_store_migrates_unversioned_measurements(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE measurements (id INTEGER PRIMARY KEY AUTOINCREMENT, image_hash TEXT NOT NULL, user_id TEXT, height_cm REAL NOT NULL, fit_type TEXT NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL)")
+    conn.execute("INSERT INTO measurements (image_hash, height_cm, fit_type, result, created_at) VALUES ('abc', 180, 'Standard', '{}', 0)")
+    conn.commit()
+    conn.close()
+
+    store = ResultStore(path)
+    assert store.find_measurement("abc", 180, "Standard", "2:mask=0") is None
+    store.close()
@@ -0,0 +1,44 @@
+import os
+import sys
+import pytest
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from style_catalog import InvalidStyleError, StyleCatalog
+
+def test_catalog_prebuilds_every_combination():
+    catalog = StyleCatalog.load()
+    assert len(catalog) == len(catalog.textures) * len(catalog.patterns) * len(catalog.collars) * len(catalog.closures) * 2
+
+    choice = catalog.resolve("fabric_white", "solid", "saudi_collar", "buttons", True)
+    assert choice.key == "fabric_white:solid:saudi_collar:buttons:pocket"
+    prompt = choice.prompt("Gold cufflinks")
+    assert "Saudi-style standing collar, crisp and structured. Gold cufflinks" in prompt
+    assert "buttons closure system, with a premium chest pocket." in prompt
+    # The choice carries its own catalog's safety settings, so a reload cannot mix the two
+    assert choice.safety_settings == catalog.safety_settings
+
+def test_catalog_cache_key_is_stable():
+    catalog = StyleCatalog.load()
+    choice = catalog.resolve("fabric_white", "solid", "saudi_collar", "buttons", True)
+    assert choice.cache_key(" ") == choice.cache_key()
+    assert choice.cache_key("Gold cufflinks") == choice.cache_key(" Gold cufflinks ")
+    assert choice.cache_key("Gold cufflinks") != choice.cache_key()
+
+def test_catalog_cache_key_changes_with_descriptions():
+    import json
+    from style_catalog import CATALOG_PATH
+    with open(CATALOG_PATH) as f:
+        data = json.load(f)
+    before = StyleCatalog(data).resolve("fabric_white", "solid", "saudi_collar", "buttons", True)
+    data["textures"]["fabric_white"] = "Bright white cotton"
+    after = StyleCatalog(data).resolve("fabric_white", "solid", "saudi_collar", "buttons", True)
+    assert before.key == after.key
+    assert before.cache_key() != after.cache_key()
+
+def test_catalog_rejects_unknown_ids():
+    catalog = StyleCatalog.load()
+    with pytest.raises(InvalidStyleError) as exc:
+        catalog.resolve("fabric_gold", "solid", "saudi_collar", "velcro", True)
+    assert exc.value.errors == {"texture_id": "fabric_gold", "closure_type": "velcro"}
@@ -0,0 +1,63 @@
+import base64
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from style_catalog import StyleChoice
+
+virtual_mirror = pytest.importorskip("virtual_mirror")
+NeuralMirror = virtual_mirror.NeuralMirror
+
+IMAGE_BYTES = b"\x89PNG fake image bytes"
+
+class FakeModel:
+    def generate_content(self, contents, safety_settings=None, stream=False):
+        assert stream
+        text = SimpleNamespace(text="A crisp white thoub. ", inline_data=None)
+        image = SimpleNamespace(text="", inline_data=SimpleNamespace(data=IMAGE_BYTES, mime_type="image/png"))
+        return iter([SimpleNamespace(parts=[text]), SimpleNamespace(parts=[image])])
+
+class FakeBucket:
+    def __init__(self, order, image_sent):
+        self.order = order
+        self.image_sent = image_sent
+
+    def upload(self, path, file, file_options=None):
+        self.order.append("storage_started")
+        # Storage must not hold back the image event
+        assert self.image_sent.wait(5)
+        assert file == IMAGE_BYTES
+
+    def get_public_url(self, path):
+        return f"https://storage.example/{path}"
+
+def test_stream_try_on_streams_before_storage_finishes(monkeypatch):
+    order = []
+    image_sent = threading.Event()
+    bucket = FakeBucket(order, image_sent)
+    supabase = SimpleNamespace(storage=SimpleNamespace(from_=lambda name: bucket))
+
+    monkeypatch.setattr(virtual_mirror.genai, "upload_file", lambda **kwargs: SimpleNamespace(uri="mem://user"))
+    mirror = NeuralMirror()
+    mirror._model = FakeModel()
+
+    events = []
+    for event in mirror.stream_try_on(
+        "uploads/user.jpg", StyleChoice("fabric_white", "white thoub ", "."), "",
+        "user.jpg", supabase_client=supabase
+    ):
+        events.append(event)
+        order.append(event["type"])
+        if event["type"] == "image":
+            image_sent.set()
+
+    assert [e["type"] for e in events] == ["text", "image", "stored"]
+    assert base64.b64decode(events[1]["data"]) == IMAGE_BYTES
+    assert events[2]["image_url"].startswith("https://storage.example/gen_user_")
+    assert order.index("storage_started") < order.index("stored")
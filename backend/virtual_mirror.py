@@ -1,10 +1,22 @@
 import google.generativeai as genai
+import base64
 import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
+from deadline import RequestCancelled, check_deadline
+from style_catalog import StyleChoice
 
 # Load env variables if .env file exists
 load_dotenv()
 
+MOCK_IMAGE_URL = "/thoub_mock_white.png"
+# Background uploads of streamed renders run here so the stream is not blocked
+_storage_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="render-storage")
+# How often a stream waiting on storage re-checks its deadline
+STORAGE_POLL_SECONDS = 0.5
+
 class NeuralMirror:
     def __init__(self):
         self._model = None
@@ -43,94 +55,93 @@ only use attached model images.
                 print("Warning: GEMINI_API_KEY not found.")
         return self._model
 
-    def generate_try_on(self, image_path: str, texture_id: str, pattern_id: str, style_config: str, closure_type: str, has_pocket: bool, extra_details: str, front_image_id: str = "custom_thoub", supabase_client=None, bucket_name="thoub-images"):
+    def _upload_source(self, image_path: str, deadline=None):
+        check_deadline(deadline, "upload")
+        print(f"Analyzing image: {image_path}")
+        # Explicitly set mime_type to fix 'Unknown mime type' error
+        sample_file = genai.upload_file(path=image_path, display_name="User Image", mime_type="image/jpeg")
+        print(f"Uploaded file: {sample_file.uri}")
+        return sample_file
+
+    def _generate_with_retries(self, contents, safety_settings, deadline=None, stream=False):
+        max_retries = 3
+        retry_delay = 2 # seconds
+
+        for attempt in range(max_retries):
+            check_deadline(deadline, "generation")
+            try:
+                print(f"AI Generation Attempt {attempt + 1}/{max_retries}...")
+                return self.model.generate_content(
+                    contents,
+                    safety_settings=safety_settings,
+                    stream=stream
+                )
+            except Exception as e:
+                last_error = str(e)
+                print(f"Attempt {attempt + 1} failed: {last_error}")
+                if attempt < max_retries - 1:
+                    if deadline:
+                        deadline.sleep(retry_delay * (attempt + 1), "generation")
+                    else:
+                        time.sleep(retry_delay * (attempt + 1))
+                else:
+                    raise e # Final attempt failed
+
+    def _store_image(self, image_data: bytes, front_image_id: str, supabase_client=None, bucket_name="thoub-images"):
+        """Persists a generated image and returns its public URL."""
+        # Use a clean base for the ID, removing URL parts if present
+        base_id = front_image_id.split('/')[-1].split('?')[0].split('.')[0]
+        timestamp = int(time.time() * 1000) # Millisecond precision
+        unique_id = str(uuid.uuid4())[:8] # Add a short UUID for absolute uniqueness
+        output_filename = f"gen_{base_id}_{timestamp}_{unique_id}.png"
+
+        if supabase_client:
+            # Upload to Supabase
+            supabase_client.storage.from_(bucket_name).upload(
+                path=output_filename,
+                file=image_data,
+                file_options={"upsert": "true", "content-type": "image/png"}
+            )
+            return supabase_client.storage.from_(bucket_name).get_public_url(output_filename)
+
+        # Save locally for development
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        output_path = os.path.abspath(os.path.join(BASE_DIR, "..", "frontend", "public", output_filename))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(image_data)
+        return f"/{output_filename}"
+
+    @staticmethod
+    def _wait_for_storage(future, deadline=None):
+        """Waits for a background upload, giving up as soon as the request is cancelled."""
+        if deadline is None:
+            return future.result()
+        while True:
+            check_deadline(deadline, "storage")
+            try:
+                return future.result(timeout=min(STORAGE_POLL_SECONDS, max(deadline.remaining(), 0.01)))
+            except FutureTimeout:
+                continue
+
+    def generate_try_on(self, image_path: str, choice: StyleChoice, extra_details: str, front_image_id: str = "custom_thoub", supabase_client=None, bucket_name="thoub-images", deadline=None):
         if not self.model:
             # Fallback to Mock if no key
             return {
-                "image_url": "/thoub_mock_white.png", 
+                "image_url": MOCK_IMAGE_URL, 
                 "description": "Mock description: Please set GEMINI_API_KEY."
             }
             
         try:
-            # 1. Upload/Load image for Gemini
-            print(f"Analyzing image: {image_path}")
-            # Explicitly set mime_type to fix 'Unknown mime type' error
-            sample_file = genai.upload_file(path=image_path, display_name="User Image", mime_type="image/jpeg")
-            print(f"Uploaded file: {sample_file.uri}")
-
-            # 2. Construct User Input with Rich Descriptions
-            
-            # Mapping dictionaries for better semantic understanding
-            COLOR_MAP = {
-                "fabric_white": "Pristine white fabric with a subtle silk-like sheen",
-                "fabric_cream": "Warm desert cream beige fabric, soft and luxurious",
-                "fabric_grey": "Sophisticated slate grey fabric with a professional matte finish",
-                "fabric_black": "Deep midnight black fabric, high-density and premium",
-                "fabric_blue": "Regal royal blue fabric, vibrant and elegant",
-                "fabric_purple": "Rich deep purple plum fabric, bold and bespoke"
-            }
-            
-            PATTERN_MAP = {
-                "solid": "Solid weave with smooth texture",
-                "pinstripe": "Subtle, narrow pinstripe weave for a tailored look",
-                "checkered": "Elegant fine checkered pattern weave"
-            }
-            
-            STYLE_MAP = {
-                "saudi_collar": "Traditional Saudi-style standing collar, crisp and structured",
-                "kuwaiti_collar": "Classic Kuwaiti-style medium-height collar with refined stitching",
-                "emirati_collar": "Minimalist Emirati-style collarless design with clean neckline",
-                "round_collar": "Modern round neckline, soft and contemporary",
-                "official_collar": "Formal official-style high collar, sharp and authoritative"
-            }
+            # 1. Construct User Input from the StyleChoice the caller resolved (and cached under)
+            user_prompt, safety_settings = choice.prompt(extra_details), choice.safety_settings
 
-            color_desc = COLOR_MAP.get(texture_id, texture_id)
-            pattern_desc = PATTERN_MAP.get(pattern_id, pattern_id)
-            style_desc = STYLE_MAP.get(style_config, style_config)
-            pocket_str = "with a premium chest pocket" if has_pocket else "without any chest pocket"
-            
-            user_prompt = f"""
-            Input 2 (Color & Fabric): {color_desc}
-            Input 3 (Collar Architecture): {style_desc}. {extra_details}
-            Input 4 (Weave Pattern): {pattern_desc}
-            Input 5 (Refined Details): {closure_type} closure system, {pocket_str}.
-            
-            Maintain the exact proportions and features of the model in the image.
-            """
-            
+            # 2. Upload/Load image for Gemini
+            sample_file = self._upload_source(image_path, deadline)
             print(f"Sending prompt to Gemini: {user_prompt.strip()}")
             
             # 3. Generate Content with Safety Settings & Retries
-            import time
-            
-            safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-
-            max_retries = 3
-            retry_delay = 2 # seconds
-            
-            response = None
-            last_error = ""
-
-            for attempt in range(max_retries):
-                try:
-                    print(f"AI Generation Attempt {attempt + 1}/{max_retries}...")
-                    response = self.model.generate_content(
-                        [sample_file, user_prompt],
-                        safety_settings=safety_settings
-                    )
-                    break # Success!
-                except Exception as e:
-                    last_error = str(e)
-                    print(f"Attempt {attempt + 1} failed: {last_error}")
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay * (attempt + 1))
-                    else:
-                        raise e # Final attempt failed
+            response = self._generate_with_retries([sample_file, user_prompt], safety_settings, deadline)
 
             description = ""
             image_url = None
@@ -151,34 +162,8 @@ only use attached model images.
                     if hasattr(part, 'inline_data') and part.inline_data:
                         # It's an image!
                         print("Image generated by NanoBanana!")
-                        image_data = part.inline_data.data
-                        
-                        # Generate a truly unique path for the image
-                        import time
-                        import uuid
-                        # Use a clean base for the ID, removing URL parts if present
-                        base_id = front_image_id.split('/')[-1].split('?')[0].split('.')[0]
-                        timestamp = int(time.time() * 1000) # Millisecond precision
-                        unique_id = str(uuid.uuid4())[:8] # Add a short UUID for absolute uniqueness
-                        output_filename = f"gen_{base_id}_{timestamp}_{unique_id}.png"
-                        
-                        if supabase_client:
-                            # Upload to Supabase
-                            supabase_client.storage.from_(bucket_name).upload(
-                                path=output_filename,
-                                file=image_data,
-                                file_options={"upsert": "true", "content-type": "image/png"}
-                            )
-                            image_url = supabase_client.storage.from_(bucket_name).get_public_url(output_filename)
-                        else:
-                            # Save locally for development
-                            BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-                            output_path = os.path.abspath(os.path.join(BASE_DIR, "..", "frontend", "public", output_filename))
-                            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                            with open(output_path, "wb") as f:
-                                f.write(image_data)
-                            image_url = f"/{output_filename}"
-                            
+                        check_deadline(deadline, "storage")
+                        image_url = self._store_image(part.inline_data.data, front_image_id, supabase_client, bucket_name)
                         description += " [Image Generated]"
 
             if not image_url:
@@ -191,6 +176,8 @@ only use attached model images.
                 "description": description if description else "Generated successfully."
             }
 
+        except RequestCancelled:
+            raise
         except Exception as e:
             print(f"Gemini Error: {e}")
             # Instead of fallback, return the actual error
@@ -199,3 +186,67 @@ only use attached model images.
                  "error": str(e),
                  "description": f"AI Generation failed: {str(e)}"
             }
+
+    def stream_try_on(self, image_path: str, choice: StyleChoice, extra_details: str, front_image_id: str = "custom_thoub", supabase_client=None, bucket_name="thoub-images", deadline=None):
+        """
+        Streaming variant of generate_try_on. Yields event dicts as the model
+        produces output:
+
+            {"type": "text", "text": ...}
+            {"type": "image", "mime_type": ..., "data": <base64>}
+            {"type": "stored", "image_url": ..., "description": ...}
+            {"type": "error", "error": ...}
+
+        Image bytes are sent to the client as soon as they arrive; persisting
+        them to storage runs in the background and is reported by the final
+        "stored" event.
+        """
+        if not self.model:
+            yield {"type": "stored", "image_url": MOCK_IMAGE_URL, "description": "Mock description: Please set GEMINI_API_KEY."}
+            return
+
+        storage_future = None
+        description = ""
+        try:
+            user_prompt, safety_settings = choice.prompt(extra_details), choice.safety_settings
+            sample_file = self._upload_source(image_path, deadline)
+            print(f"Streaming prompt to Gemini: {user_prompt.strip()}")
+
+            response = self._generate_with_retries([sample_file, user_prompt], safety_settings, deadline, stream=True)
+
+            for chunk in response:
+                check_deadline(deadline, "generation")
+                for part in getattr(chunk, "parts", []):
+                    if getattr(part, "text", None):
+                        description += part.text
+                        yield {"type": "text", "text": part.text}
+                    if getattr(part, "inline_data", None) and part.inline_data.data:
+                        image_data = part.inline_data.data
+                        print("Image generated by NanoBanana! (streamed)")
+                        if storage_future is None:
+                            check_deadline(deadline, "storage")
+                            storage_future = _storage_pool.submit(
+                                self._store_image, image_data, front_image_id, supabase_client, bucket_name
+                            )
+                        yield {
+                            "type": "image",
+                            "mime_type": part.inline_data.mime_type or "image/png",
+                            "data": base64.b64encode(image_data).decode("ascii")
+                        }
+
+            if storage_future is None:
+                raise Exception("Gemini completed but did not produce an image. Please check your prompt or try again.")
+
+            image_url = self._wait_for_storage(storage_future, deadline)
+            print("Gemini Streaming Complete.")
+            yield {
+                "type": "stored",
+                "image_url": image_url,
+                "description": (description + " [Image Generated]") if description else "Generated successfully."
+            }
+
+        except RequestCancelled as rc:
+            yield {"type": "error", "error": str(rc)}
+        except Exception as e:
+            print(f"Gemini Stream Error: {e}")
+            yield {"type": "error", "error": str(e)}